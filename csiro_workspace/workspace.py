@@ -27,15 +27,23 @@ This copyright notice must be included with all copies of the source code.
 
 from ctypes import cdll, byref, c_char, c_char_p, c_int, c_void_p, c_bool, Structure, pointer, POINTER, CFUNCTYPE
 import platform
-import copy
+import collections
+import contextlib
 import subprocess
 import atexit
 import uuid
 import json
-import datetime
+import time
 import os.path
 import ctypes
 
+# WatchLists are parsed from JSON on every watch event, so use orjson for
+# this when it's available.
+try:
+    from orjson import loads as _jsonLoads
+except ImportError:
+    from json import loads as _jsonLoads
+
 class _WORKSPACE_ID(Structure):
     """
     Struct for our WorkspaceId type. Maps to a C struct in the WorkspaceWeb
@@ -50,9 +58,23 @@ class _WORKSPACE_ID(Structure):
         return int(self.key)
 
 
-# Load our Workspace config file
-_ws_config_file = open(os.path.dirname(__file__) + '/workspace.cfg', 'r')
-_ws_config = json.load(_ws_config_file)
+# Directory containing this module, and therefore our workspace.cfg file.
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Our Workspace config. Read from workspace.cfg the first time it's needed
+# rather than on import.
+_ws_config = None
+
+def _getConfig():
+    """
+    Returns our Workspace config as a dictionary, loading it from the
+    workspace.cfg file alongside this module on first use.
+    """
+    global _ws_config
+    if _ws_config is None:
+        with open(os.path.join(_MODULE_DIR, 'workspace.cfg'), 'r') as configFile:
+            _ws_config = json.load(configFile)
+    return _ws_config
 
 # Function types for our C++ code to call back into
 LOOPSTARTFUNC = CFUNCTYPE(c_int)
@@ -63,79 +85,152 @@ ERRORFUNC     = CFUNCTYPE(c_int, POINTER(_WORKSPACE_ID), c_char_p)
 WATCHFUNC     = CFUNCTYPE(c_int, POINTER(_WORKSPACE_ID), c_char_p)
 LISTFUNC      = CFUNCTYPE(c_int, POINTER(_WORKSPACE_ID), c_char_p)
 
-# Our C++ function references
-LibWorkspaceWeb = None
-if platform.system() == 'Windows':
-    LibWorkspaceWeb = ctypes.WinDLL(_ws_config['workspace_install_dir'] + '/lib/workspaceweb.dll', winmode = 0x8)
-elif platform.system() == 'Linux':
-    LibWorkspaceWeb = cdll.LoadLibrary(_ws_config['workspace_install_dir'] + '/lib/libworkspaceweb.so')
-else:
-    LibWorkspaceWeb = cdll.LoadLibrary(_ws_config['workspace_install_dir'] + '/lib/libworkspaceweb.dylib')
-server_init                           = LibWorkspaceWeb.server_init
-server_listen_for_connection_and_wait = LibWorkspaceWeb.server_listen_for_connection_and_wait
-server_start_event_loop               = LibWorkspaceWeb.server_start_event_loop
-server_stop_event_loop                = LibWorkspaceWeb.server_stop_event_loop
-workspace_register_func_success       = LibWorkspaceWeb.workspace_register_func_success
-workspace_register_func_failed        = LibWorkspaceWeb.workspace_register_func_failed
-workspace_register_func_error         = LibWorkspaceWeb.workspace_register_func_error
-server_poll                           = LibWorkspaceWeb.server_poll
-workspace_run_once                    = LibWorkspaceWeb.workspace_run_once
-workspace_run_continuously            = LibWorkspaceWeb.workspace_run_continuously
-workspace_terminate                   = LibWorkspaceWeb.workspace_terminate
-workspace_set_input                   = LibWorkspaceWeb.workspace_set_input
-workspace_set_global_name             = LibWorkspaceWeb.workspace_set_global_name
-workspace_list_inputs                 = LibWorkspaceWeb.workspace_list_inputs
-workspace_list_outputs                = LibWorkspaceWeb.workspace_list_outputs
-workspace_list_global_names           = LibWorkspaceWeb.workspace_list_global_names
-workspace_watch                       = LibWorkspaceWeb.workspace_watch
-workspace_cancel_watch                = LibWorkspaceWeb.workspace_cancel_watch
-workspace_stop                        = LibWorkspaceWeb.workspace_stop
-
-def _initCInterface():
+# Location of the WorkspaceWeb shared library within the Workspace install
+# directory. Any platform not listed here is assumed to be OSX.
+_LIB_PATHS = {
+    'Windows': os.path.join('lib', 'workspaceweb.dll'),
+    'Linux':   os.path.join('lib', 'libworkspaceweb.so'),
+}
+_PLATFORM = platform.system()
+_LIB_PATH = _LIB_PATHS.get(_PLATFORM, os.path.join('lib', 'libworkspaceweb.dylib'))
+
+def _loadLibrary(installDir):
+    """
+    Loads the WorkspaceWeb shared library from the Workspace install
+    directory `installDir`.
+    """
+    path = os.path.normpath(os.path.join(installDir, _LIB_PATH))
+    if _PLATFORM == 'Windows':
+        return ctypes.WinDLL(path, winmode = 0x8)
+    return cdll.LoadLibrary(path)
+
+# Return type and parameter types of each function we use from the C-API.
+_PROTOS = (
+    ('server_init',                           c_int, (c_int,)),
+    ('server_listen_for_connection_and_wait', c_int, (c_char_p, c_int, CONNFUNC)),
+    ('server_start_event_loop',               c_int, (LOOPSTARTFUNC,)),
+    ('server_stop_event_loop',                c_int, ()),
+    ('server_poll',                           c_int, (c_int,)),
+    ('workspace_register_func_success',       c_int, (POINTER(_WORKSPACE_ID), SUCCESSFUNC)),
+    ('workspace_register_func_failed',        c_int, (POINTER(_WORKSPACE_ID), FAILFUNC)),
+    ('workspace_register_func_error',         c_int, (POINTER(_WORKSPACE_ID), ERRORFUNC)),
+    ('workspace_run_once',                    c_int, (POINTER(_WORKSPACE_ID),)),
+    ('workspace_run_continuously',            c_int, (POINTER(_WORKSPACE_ID),)),
+    ('workspace_terminate',                   c_int, (POINTER(_WORKSPACE_ID),)),
+    ('workspace_set_input',                   c_int, (POINTER(_WORKSPACE_ID), c_char_p, c_char_p)),
+    ('workspace_set_global_name',             c_int, (POINTER(_WORKSPACE_ID), c_char_p, c_char_p)),
+    ('workspace_list_inputs',                 c_int, (POINTER(_WORKSPACE_ID), LISTFUNC)),
+    ('workspace_list_outputs',                c_int, (POINTER(_WORKSPACE_ID), LISTFUNC)),
+    ('workspace_list_global_names',           c_int, (POINTER(_WORKSPACE_ID), LISTFUNC)),
+    ('workspace_watch',                       c_int, (POINTER(_WORKSPACE_ID), c_char_p, WATCHFUNC)),
+    ('workspace_cancel_watch',                c_int, (POINTER(_WORKSPACE_ID), c_char_p)),
+    ('workspace_stop',                        c_int, (POINTER(_WORKSPACE_ID),)),
+)
+
+def _initCInterface(lib):
     """
-    Initialises our C++ function references, assigning the correct parameter
-    types and return types.
+    Initialises our C++ function references on the loaded library `lib`,
+    assigning the parameter types and return types listed in `_PROTOS`.
     """
-    server_init.restype = c_int
-    server_init.argtypes = [c_int]
-    server_listen_for_connection_and_wait.restype = c_int
-    server_listen_for_connection_and_wait.argtypes = [c_char_p, c_int, CONNFUNC]
-    server_start_event_loop.restype = c_int
-    server_start_event_loop.argtypes = [LOOPSTARTFUNC]
-    server_stop_event_loop.restype = c_int
-    workspace_register_func_success.restype = c_int
-    workspace_register_func_success.argtypes = [POINTER(_WORKSPACE_ID), SUCCESSFUNC]
-    workspace_register_func_failed.restype = c_int
-    workspace_register_func_failed.argtypes = [POINTER(_WORKSPACE_ID), FAILFUNC]
-    workspace_register_func_error.restype = c_int
-    workspace_register_func_error.argtypes = [POINTER(_WORKSPACE_ID), ERRORFUNC]
-    server_poll.restype = c_int
-    server_poll.argtypes = [c_int]
-    workspace_run_once.restype = c_int
-    workspace_run_once.argtypes = [POINTER(_WORKSPACE_ID)]
-    workspace_run_continuously.restype = c_int
-    workspace_run_continuously.argtypes = [POINTER(_WORKSPACE_ID)]
-    workspace_terminate.restype = c_int
-    workspace_terminate.argtypes = [POINTER(_WORKSPACE_ID)]
-    workspace_set_input.restype = c_int
-    workspace_set_input.argtypes = [POINTER(_WORKSPACE_ID), c_char_p, c_char_p]
-    workspace_set_global_name.restype = c_int
-    workspace_set_global_name.argtypes = [POINTER(_WORKSPACE_ID), c_char_p, c_char_p]
-    workspace_list_inputs.restype = c_int
-    workspace_list_inputs.argtypes = [POINTER(_WORKSPACE_ID), LISTFUNC]
-    workspace_list_outputs.restype = c_int
-    workspace_list_outputs.argtypes = [POINTER(_WORKSPACE_ID), LISTFUNC]
-    workspace_list_global_names.restype = c_int
-    workspace_list_global_names.argtypes = [POINTER(_WORKSPACE_ID), LISTFUNC]
-    workspace_watch.restype = c_int
-    workspace_watch.argtypes = [POINTER(_WORKSPACE_ID), c_char_p, WATCHFUNC]
-    workspace_cancel_watch.restype = c_int
-    workspace_cancel_watch.argtypes = [POINTER(_WORKSPACE_ID), c_char_p]
-    workspace_stop.restype = c_int
-    workspace_stop.argtypes = [POINTER(_WORKSPACE_ID)]
+    for name, restype, argtypes in _PROTOS:
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = list(argtypes)
 
     # Initialise the server
-    server_init(_ws_config['log_level'])
+    lib.server_init(_getConfig()['log_level'])
+
+
+class _LibLoader(object):
+    """
+    Lazy handle to the WorkspaceWeb shared library. The library is only
+    loaded, and its function prototypes initialised, the first time one of
+    its functions is accessed. This keeps importing the module cheap for code
+    that never creates a Workspace.
+    """
+    def __init__(self):
+        self._lib = None
+        self._loadError = None
+
+    def load(self):
+        """
+        Loads the library if it hasn't been already, returning whether it is
+        available. A failed load is remembered so that we don't try to open
+        the library again on every call.
+        """
+        if self._lib is None and self._loadError is None:
+            # Problems with the config file itself are raised as they are,
+            # rather than being reported as a missing library.
+            installDir = _getConfig()['workspace_install_dir']
+            try:
+                lib = _loadLibrary(installDir)
+            except OSError as e:
+                self._loadError = ('Failed to load the WorkspaceWeb library (%s). '
+                                   'Check "workspace_install_dir" in workspace.cfg.' % e)
+                return False
+            _initCInterface(lib)
+            self._lib = lib
+        return self._lib is not None
+
+    def __getattr__(self, name):
+        """
+        Only invoked for functions that have not yet been resolved. Each one
+        is stored on this object once resolved, so subsequent accesses are
+        plain attribute lookups.
+        """
+        # None of the C-API's functions are private, so don't load the library
+        # just because something probed us for a private attribute.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if not self.load():
+            raise RuntimeError(self._loadError)
+        func = getattr(self._lib, name)
+        setattr(self, name, func)
+        return func
+
+# Our C++ function references
+LibWorkspaceWeb = _LibLoader()
+
+# The C-API functions used to be bound as module attributes at import time.
+# Keep resolving those names, now through the lazily loaded library.
+_PROTO_NAMES = frozenset(name for name, restype, argtypes in _PROTOS)
+
+def __getattr__(name):
+    """
+    Resolves the C-API function names (e.g. `workspace_run_once`) as module
+    attributes, loading the library on first use.
+    """
+    if name in _PROTO_NAMES:
+        return getattr(LibWorkspaceWeb, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# Cache of ASCII-encoded input and global names. Callers tend to set the same
+# few names over and over, so we avoid re-encoding them on every call.
+_encodedNames = {}
+_ENCODED_NAMES_MAX = 1024
+
+def _encodeName(name):
+    """
+    Returns `name` encoded as ASCII bytes, ready to pass as a c_char_p.
+    """
+    encoded = _encodedNames.get(name)
+    if encoded is None:
+        if len(_encodedNames) >= _ENCODED_NAMES_MAX:
+            _encodedNames.clear()
+        encoded = _encodedNames[name] = bytes(name, "ascii")
+    return encoded
+
+def _encodeContent(content):
+    """
+    Returns the serialized `content` of an input or global name as ASCII
+    bytes. Content that is already `bytes` is passed through untouched, and
+    strings are encoded directly rather than being converted first.
+    """
+    if isinstance(content, bytes):
+        return content
+    if type(content) is str:
+        return content.encode("ascii")
+    return str(content).encode("ascii")
 
 
 class IONotExistsError(Exception):
@@ -164,6 +259,8 @@ class WatchList(object):
     `Workspace.watch()` which will monitor the specific inputs/outputs for
     updates. Wraps the C-API's WatchList class to manage scoped deletion etc.
     """
+    __slots__ = ('_id', '_inputs', '_outputs', '_globalNames')
+
     @classmethod
     def fromIONames(cls, inputs=[], outputs=[], globalNames=[]):
         """
@@ -172,15 +269,9 @@ class WatchList(object):
         list of global names to watch.
         """
         id = str(uuid.uuid4())
-        inputsDict = {}
-        for name in inputs:
-            inputsDict[name] = {}
-        outputsDict = {}
-        for name in outputs:
-            outputsDict[name] = {}
-        globalNamesDict = {}
-        for name in globalNames:
-            globalNamesDict[name] = {}
+        inputsDict = {name: {} for name in inputs}
+        outputsDict = {name: {} for name in outputs}
+        globalNamesDict = {name: {} for name in globalNames}
 
         return cls(id, inputsDict, outputsDict, globalNamesDict)
 
@@ -219,13 +310,16 @@ class WatchList(object):
         identify the WatchList. If an `id` parameter is not present in the
         string, `None` will be returned.
         """
-        wl = json.loads(jsonStr)
-        if 'id' not in wl.keys():
+        # Payloads without an id are discarded anyway, so don't bother parsing
+        # them. `jsonStr` may be bytes when it comes straight from the C-API.
+        if (b'"id"' if isinstance(jsonStr, bytes) else '"id"') not in jsonStr:
+            return None
+
+        wl = _jsonLoads(jsonStr)
+        if 'id' not in wl:
             return None
 
-        return cls(wl['id'], wl['inputs'] if 'inputs' in wl.keys() else {},
-                             wl['outputs'] if 'outputs' in wl.keys() else {},
-                             wl['globalNames'] if 'globalNames' in wl.keys() else {})
+        return cls(wl['id'], wl.get('inputs', {}), wl.get('outputs', {}), wl.get('globalNames', {}))
 
     def __init__(self, id, inputs, outputs, globalNames):
         """
@@ -241,7 +335,7 @@ class WatchList(object):
         """
         Return the WatchList in JSON format.
         """
-        return json.dumps(self.asDict())
+        return json.dumps(self.asDict(), separators=(',', ':'))
 
     def asDict(self):
         """
@@ -292,6 +386,8 @@ class _WatchCallback(object):
     Workspace. Can specify the autodelete parameter to control whether or not
     the callback is automatically deleted after it is invoked.
     """
+    __slots__ = ('workspace', 'watchId', 'callback', 'autodelete')
+
     def __init__(self, workspace, watchId, callback, autodelete=True):
         """
         Constructs a new _WatchCallback. When triggered in response to a watch
@@ -367,7 +463,7 @@ class Workspace:
     # something goes wrong during the terminate communication process (e.g.
     # child process is frozen)
     _SERVER_ADDRESS = b'127.0.0.1'
-    _terminating_processes = []
+    _terminating_processes = collections.deque()
     _registered_workspaces = {}
     _event_loop_running    = False
 
@@ -382,9 +478,31 @@ class Workspace:
             Workspace.stopEventLoop()
 
         # Don't forget we also need to make sure all our workspace processes
-        # are shut down, since we started them!
-        for key in Workspace._registered_workspaces.keys():
-            Workspace._registered_workspaces[key].terminate()
+        # are shut down, since we started them! Ask every one of them to
+        # terminate first so that they all shut down at the same time, then
+        # give each one until its kill deadline to do so before killing it.
+        # Processes that were already terminating keep the deadline they were
+        # given by terminate(), rather than getting a fresh timeout.
+        for ws in list(Workspace._registered_workspaces.values()):
+            ws.terminate()
+
+        terminating = Workspace._terminating_processes
+        while terminating:
+            killDeadline, ws = terminating.popleft()
+            try:
+                ws._process.wait(max(0, killDeadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                ws._process.kill()
+            ws._cleanup()
+
+    @staticmethod
+    def isAvailable():
+        """
+        Returns whether the WorkspaceWeb library could be loaded from the
+        Workspace install directory named in _workspace.cfg_. If it can't be,
+        every other interaction with Workspace will raise a `RuntimeError`.
+        """
+        return LibWorkspaceWeb.load()
 
     @staticmethod
     def startEventLoop(onStartFunc):
@@ -402,7 +520,7 @@ class Workspace:
         *Note:* failure to stop the event loop will cause the application to
         hang on exit.
         """
-        server_start_event_loop(LOOPSTARTFUNC(onStartFunc))
+        LibWorkspaceWeb.server_start_event_loop(LOOPSTARTFUNC(onStartFunc))
         Workspace._event_loop_running = True
 
     @staticmethod
@@ -410,7 +528,7 @@ class Workspace:
         """
         Stops the event loop if it is running.
         """
-        server_stop_event_loop()
+        LibWorkspaceWeb.server_stop_event_loop()
 
     @staticmethod
     def poll(timeoutMs=0):
@@ -421,112 +539,137 @@ class Workspace:
 
         The `timeoutMs` parameter should be a number representing how long the
         method should wait until returning in the case that there are no new
-        updates available.
-        """
-        server_poll(timeoutMs)
-
-        # Each time we poll, we iterate over the list of existing terminating
-        # procesess and kill them if they've been taking too long to shut down.
-        # If a process has already been shutdown correctly, we just remove it
-        # from the list.
-        for procRef in Workspace._terminating_processes:
-            ws = procRef[1]
-            timeTerminated = procRef[0]
-            if None == ws._process.poll():
-                if (datetime.datetime.now() - timeTerminated).seconds > _ws_config['terminate_timeout_sec']:
-                    ws._process.kill()
-                    ws._cleanup()
-                    Workspace._terminating_processes.remove(procRef)
-            else:
-                Workspace._terminating_processes.remove(procRef)
-                ws._cleanup()
-
-    def _createConnectedCallback(self, onConnected):
-        """
-        Factory method to create an success callback function that can
-        be invoked by ctypes that still has access to 'self' because it
-        is a closure.
-        """
-        def callback(workspaceId):
-            self._id = copy.deepcopy(workspaceId.contents)
-
-            # Register the workspace itself so that it can be cleaned up later
-            # if need be.
-            Workspace._registered_workspaces[self.id] = self
-
-            # Register success, failed and error callbacks. Make sure to store them
-            # in the local workspace, otherwise they'll get garbage collected
-            # before being invoked.
-            workspace_register_func_success(workspaceId, self._successCallback)
-            workspace_register_func_failed(workspaceId, self._failedCallback)
-            workspace_register_func_error(workspaceId, self._errorCallback)
-
-            # Invoke our callback for when a process has connected successfully
-            return onConnected(self)
-        return CONNFUNC(callback)
-
-    def _createSuccessCallback(self):
-        """
-        Factory method to create an success callback function that can
-        be invoked by ctypes that still has access to 'self' because it
-        is a closure.
-        """
-        def callback(workspaceId):
-            try:
-                return self._onSuccessFunc(self)
-            except:
-                return True
-        return SUCCESSFUNC(callback)
+        updates available. The GIL is released while waiting, so other Python
+        threads continue to run during a blocking poll.
+        """
+        LibWorkspaceWeb.server_poll(timeoutMs)
+
+        # Each time we poll, we check the queue of terminating processes and
+        # kill any that have been taking too long to shut down. If a process
+        # has already been shutdown correctly, we just drop it from the queue.
+        # Every process gets the same timeout, so the queue is ordered by kill
+        # deadline. Once we reach a process whose deadline hasn't passed, none
+        # of the processes behind it can be due either.
+        terminating = Workspace._terminating_processes
+        if not terminating:
+            return
+        now = time.monotonic()
+        while terminating:
+            killDeadline, ws = terminating[0]
+            if ws._process.poll() is None:
+                if now < killDeadline:
+                    break
+                ws._process.kill()
+            terminating.popleft()
+            ws._cleanup()
+
+    def _connected(self, workspaceId, onConnected):
+        """
+        Invoked once our newly started process has connected, from within the
+        blocking listen call in `Workspace.__init__`. Registers this Workspace
+        under the id it was given and invokes the user's `onConnected`.
+        """
+        # Take our own copy of the id, as the struct we've been handed
+        # belongs to the C library. It's plain data, so a flat copy of
+        # its bytes is all that's needed.
+        self._id = _WORKSPACE_ID.from_buffer_copy(workspaceId.contents)
+        self._key = self._id.getKey()
+
+        # Every call into the C-API takes a pointer to our id, so build
+        # the reference once rather than on each call.
+        self._idRef = byref(self._id)
+
+        # Register the workspace itself so that it can be cleaned up later
+        # if need be.
+        Workspace._registered_workspaces[self.id] = self
+
+        # Register success, failed and error callbacks. These are shared
+        # by all workspaces, and find this one again through its id.
+        LibWorkspaceWeb.workspace_register_func_success(workspaceId, _SUCCESS_CALLBACK)
+        LibWorkspaceWeb.workspace_register_func_failed(workspaceId, _FAILED_CALLBACK)
+        LibWorkspaceWeb.workspace_register_func_error(workspaceId, _ERROR_CALLBACK)
+
+        # Invoke our callback for when a process has connected successfully
+        return onConnected(self)
 
-    def _createFailedCallback(self):
+    @staticmethod
+    def _fromId(workspaceId):
         """
-        Factory method to create an failure callback function that can
-        be invoked by ctypes that still has access to 'self' because it
-        is a closure.
+        Returns the registered Workspace identified by `workspaceId`, a
+        pointer to a _WORKSPACE_ID passed to us by the C library, or None if
+        no such Workspace is registered.
         """
-        def callback(workspaceId):
-            try:
-                return self._onFailedFunc(self)
-            except:
-                return True
-        return FAILFUNC(callback)
+        return Workspace._registered_workspaces.get(workspaceId.contents.key)
+
+    @staticmethod
+    def _dispatchSuccess(workspaceId):
+        """
+        Shared success callback invoked by ctypes for every Workspace. Forwards
+        to the function registered with `onSuccess` on the Workspace that
+        `workspaceId` refers to.
+        """
+        ws = Workspace._fromId(workspaceId)
+        try:
+            return ws._onSuccessFunc(ws)
+        except:
+            return True
 
-    def _createErrorCallback(self):
+    @staticmethod
+    def _dispatchFailed(workspaceId):
         """
-        Factory method to create an error callback function that can
-        be invoked by ctypes that still has access to 'self' because it
-        is a closure.
+        Shared failure callback invoked by ctypes for every Workspace. Forwards
+        to the function registered with `onFailed` on the Workspace that
+        `workspaceId` refers to.
         """
-        def callback(workspaceId, errorMessage):
-            try:
-                return self._onErrorFunc(self, errorMessage)
-            except:
-                return True
-        return ERRORFUNC(callback)
+        ws = Workspace._fromId(workspaceId)
+        try:
+            return ws._onFailedFunc(ws)
+        except:
+            return True
+
+    @staticmethod
+    def _dispatchError(workspaceId, errorMessage):
+        """
+        Shared error callback invoked by ctypes for every Workspace. Forwards
+        to the function registered with `onError` on the Workspace that
+        `workspaceId` refers to.
+        """
+        ws = Workspace._fromId(workspaceId)
+        try:
+            return ws._onErrorFunc(ws, errorMessage)
+        except:
+            return True
 
-    def _create_WatchCallback(self):
+    @staticmethod
+    def _dispatchWatch(workspaceId, watchListStr):
         """
-        Factory method to create an watch callback function that can
-        be invoked by ctypes that still has access to 'self' because it
-        is a closure.
+        Shared watch callback invoked by ctypes for every Workspace. Forwards
+        to the _WatchCallback registered for the watch list's id on the
+        Workspace that `workspaceId` refers to.
         """
-        def callback(workspaceId, watchListStr):
-            wl = WatchList.fromJson(watchListStr)
-            if wl and wl.id in self._watches.keys():
-                return self._watches[wl.id](wl)
-        return WATCHFUNC(callback)
+        ws = Workspace._fromId(workspaceId)
+        wl = WatchList.fromJson(watchListStr)
+        if ws is not None and wl is not None and wl.id in ws._watches:
+            return ws._watches[wl.id](wl)
+        return True
 
-    def _createListCallback(self, ioType):
+    @staticmethod
+    def _createListCallback(requestAttr):
         """
-        Factory method to create a callback function to invoke when a request
-        for a list of inputs / outputs / globalNames is made. As with the other
-        callback methods, 'self' is available because the callback is a closure.
+        Factory method to create the shared callback function to invoke when
+        a request for a list of inputs / outputs / globalNames is made. The
+        callback forwards to the function stored in the `requestAttr`
+        attribute of the Workspace that `workspaceId` refers to, clearing it
+        first so that the function may safely make another list request.
         """
         def callback(workspaceId, ioListStr):
+            ws = Workspace._fromId(workspaceId)
+            if ws is None:
+                return True
             ioList = WatchList.fromJson(ioListStr)
-            result = self._listRequests[ioType](self, ioList)
-            del self._listRequests[ioType]
-            return result
+            listCallback = getattr(ws, requestAttr)
+            setattr(ws, requestAttr, None)
+            return listCallback(ws, ioList)
         return LISTFUNC(callback)
 
     def _removeWatch(self, watchId):
@@ -538,21 +681,15 @@ class Workspace:
 
     def _cleanup(self):
         """
-        Clean up the workspace after it has terminated. We need to do this to
-        make sure we safely delete all of our closures while they are not in
-        call. If we don't delete them, the workspace object's reference count
-        will never reach zero.
+        Clean up the workspace after it has terminated. We need to drop our
+        registration so that the shared callbacks no longer find us, otherwise
+        the workspace object's reference count will never reach zero. A newer
+        Workspace may have been given our key while we were terminating, in
+        which case the registration is no longer ours to drop.
         """
         self._process = None
-        del self._connectedCallback
-        del self._successCallback
-        del self._failedCallback
-        del self._errorCallback
-        del self._watchCallback
-        del self._listCallbackInputs
-        del self._listCallbackOutputs
-        del self._listCallbackGlobalNames
-        del Workspace._registered_workspaces[self.id]
+        if Workspace._registered_workspaces.get(self.id) is self:
+            del Workspace._registered_workspaces[self.id]
 
     def __init__(self, fileName, onConnected):
         """
@@ -569,42 +706,47 @@ class Workspace:
         Workspace instance via this class' member functions will fail.
         """
         self._fileName = fileName
+        self._terminating = False
         self._watches = dict()
-        self._listRequests = dict()
-
-        # Use our factory methods to create all our callback functions. These
-        # callback functions are used to forward on to the functions that the
-        # user registers.
-        self._connectedCallback = self._createConnectedCallback(onConnected)
-        self._successCallback = self._createSuccessCallback()
-        self._failedCallback = self._createFailedCallback()
-        self._errorCallback = self._createErrorCallback()
-        self._watchCallback = self._create_WatchCallback()
-        self._listCallbackInputs = self._createListCallback('inputs')
-        self._listCallbackOutputs = self._createListCallback('outputs')
-        self._listCallbackGlobalNames = self._createListCallback('globalNames')
+        self._inputsListRequest = None
+        self._outputsListRequest = None
+        self._globalNamesListRequest = None
+
+
+        # Resolve the C-API before starting the process, so that a library
+        # that fails to load doesn't leave an orphaned process behind.
+        config = _getConfig()
+        listenForConnectionAndWait = LibWorkspaceWeb.server_listen_for_connection_and_wait
 
         # Start our actual child process. We start it first since it's
-        # asynchronous, whereas our server isn't (since we don't have an event loop)
+        # asynchronous, whereas our server isn't (since we don't have an event loop).
+        # Popen's default of closing inherited descriptors matters here: the
+        # sockets opened by the C library aren't covered by PEP 446, and must
+        # not leak into the child.
         self._process = subprocess.Popen([
-            _ws_config['workspace_install_dir'] + '/bin/workspace-web',
+            os.path.join(config['workspace_install_dir'], 'bin', 'workspace-web'),
             fileName,
-            '--port', '%d' % _ws_config['connection_port'],
-            '--log-level', '%d' % _ws_config['log_level']
+            '--port', '%d' % config['connection_port'],
+            '--log-level', '%d' % config['log_level']
         ])
 
-        # Listen to connections from our new process.
-        success = server_listen_for_connection_and_wait(Workspace._SERVER_ADDRESS, _ws_config['connection_port'], self._connectedCallback)
+        # Listen to connections from our new process. The connected callback
+        # is only needed for the duration of this blocking call, so it is
+        # created here rather than shared between workspaces.
+        def connected(workspaceId):
+            return self._connected(workspaceId, onConnected)
+        connectedCallback = CONNFUNC(connected)
+        success = listenForConnectionAndWait(Workspace._SERVER_ADDRESS, config['connection_port'], connectedCallback)
         if not success:
             raise RuntimeError('Failed to connect to Workspace process running "%s"' % fileName)
 
     @property
     def id(self):
         """
-        Returns a string representing the unique identifier of this Workspace
+        Returns the integer key that uniquely identifies this Workspace
         instance.
         """
-        return self._id.getKey()
+        return self._key
 
     @property
     def fileName(self):
@@ -626,7 +768,7 @@ class Workspace:
         either completes or fails. It is the responsibility of the user to
         re-execute it as required.
         """
-        workspace_run_once(byref(self._id))
+        LibWorkspaceWeb.workspace_run_once(self._idRef)
 
     def runContinuously(self):
         """
@@ -636,7 +778,7 @@ class Workspace:
         is updated via the `setInput` or `setGlobalName` methods, the workflow
         will re-execute the affected parts of the workflow.
         """
-        workspace_run_continuously(byref(self._id))
+        LibWorkspaceWeb.workspace_run_continuously(self._idRef)
 
     def stop(self):
         """
@@ -648,22 +790,24 @@ class Workspace:
 
         __*Note:* This method is asynchronous__
         """
-        workspace_stop(byref(self._id))
+        LibWorkspaceWeb.workspace_stop(self._idRef)
 
     def terminate(self):
         """
         Requests that the workspace-web suprocess shut down immediately.
         """
-        if not self._process:
+        if not self._process or self._terminating:
             return
+        self._terminating = True
 
         # Calling this will tell the process to terminate itself.
-        success = workspace_terminate(byref(self._id))
+        success = LibWorkspaceWeb.workspace_terminate(self._idRef)
 
         # Before we get rid of the process reference, store it in the queue of
         # terminating processes so that we can get kill it if it doesn't
         # promptly terminate itself.
-        Workspace._terminating_processes.append((datetime.datetime.now(), self))
+        killDeadline = time.monotonic() + _getConfig()['terminate_timeout_sec']
+        Workspace._terminating_processes.append((killDeadline, self))
 
     def setInput(self, inputName, content):
         """
@@ -676,10 +820,29 @@ class Workspace:
         a string representing a floating-point number is required. If the input
         is of a more complex type, such as a DataCollection, then `content`
         must contain the serialized XML that can be read into this datatype.
+        Content that is already serialized to ASCII `bytes` is passed to
+        Workspace as-is.
+
+        __*Note:* This method is asynchronous__
+        """
+        return LibWorkspaceWeb.workspace_set_input(self._idRef, _encodeName(inputName), _encodeContent(content))
+
+    def setInputs(self, inputs):
+        """
+        Assigns several top-level inputs at once, where `inputs` is a
+        dictionary mapping each input name to its content. Each item is
+        applied exactly as if `setInput` had been called for it, in the order
+        given by the dictionary.
+
+        Returns a dictionary mapping each input name to the result `setInput`
+        would have returned for it, so that a failed assignment can be found.
 
         __*Note:* This method is asynchronous__
         """
-        return workspace_set_input(byref(self._id), bytes(inputName, "ascii"), bytes(str(content), "ascii"))
+        setInput = LibWorkspaceWeb.workspace_set_input
+        idRef = self._idRef
+        return {inputName: setInput(idRef, _encodeName(inputName), _encodeContent(content))
+                for inputName, content in inputs.items()}
 
     def setGlobalName(self, globalName, content):
         """
@@ -692,10 +855,12 @@ class Workspace:
         a string representing a floating-point number is required. If the input
         is of a more complex type, such as a DataCollection, then `content`
         must contain the serialized XML that can be read into this datatype.
+        Content that is already serialized to ASCII `bytes` is passed to
+        Workspace as-is.
 
         __*Note:* This method is asynchronous__
         """
-        return workspace_set_global_name(byref(self._id), bytes(globalName, "ascii"), bytes(str(content), "ascii"))
+        return LibWorkspaceWeb.workspace_set_global_name(self._idRef, _encodeName(globalName), _encodeContent(content))
 
     def watch(self, callback, watchList, autoDelete=True):
         """
@@ -709,7 +874,7 @@ class Workspace:
         __*Note:* This method is asynchronous__
         """
         self._watches[watchList.id] = _WatchCallback(self, watchList.id, callback, autoDelete)
-        if workspace_watch(byref(self._id), bytes(str(watchList), "ascii"), self._watchCallback, autoDelete):
+        if LibWorkspaceWeb.workspace_watch(self._idRef, bytes(str(watchList), "ascii"), _WATCH_CALLBACK, autoDelete):
             return watchList.id
         return None
 
@@ -719,7 +884,31 @@ class Workspace:
         existing callback associated with the `watchId`.
         """
         self._removeWatch(watchId)
-        workspace_cancel_watch(byref(self._id), bytes(str(watchId), "ascii"))
+        LibWorkspaceWeb.workspace_cancel_watch(self._idRef, bytes(str(watchId), "ascii"))
+
+    @contextlib.contextmanager
+    def watching(self, callback, watchList, autoDelete=False):
+        """
+        Context manager that sets up a watch exactly as `watch` does, yields
+        its watch id, and cancels the watch when the block exits (including
+        when an exception is raised), unless it has already removed itself.
+        Raises a `RuntimeError` if the watch could not be set up.
+
+        ```python
+        with ws.watching(watchCallback, watchList):
+            ...
+        ```
+
+        __*Note:* This method is asynchronous__
+        """
+        if self.watch(callback=callback, watchList=watchList, autoDelete=autoDelete) is None:
+            self._removeWatch(watchList.id)
+            raise RuntimeError('Failed to watch "%s"' % watchList.id)
+        try:
+            yield watchList.id
+        finally:
+            if watchList.id in self._watches:
+                self.cancelWatch(watchList.id)
 
     def listInputs(self, callback):
         """
@@ -728,8 +917,8 @@ class Workspace:
 
         __*Note:* This method is asynchronous__
         """
-        self._listRequests['inputs'] = callback
-        return workspace_list_inputs(byref(self._id), self._listCallbackInputs);
+        self._inputsListRequest = callback
+        return LibWorkspaceWeb.workspace_list_inputs(self._idRef, _LIST_INPUTS_CALLBACK);
 
     def listOutputs(self, callback):
         """
@@ -738,8 +927,8 @@ class Workspace:
 
         __*Note:* This method is asynchronous__
         """
-        self._listRequests['outputs'] = callback
-        return workspace_list_outputs(byref(self._id), self._listCallbackOutputs);
+        self._outputsListRequest = callback
+        return LibWorkspaceWeb.workspace_list_outputs(self._idRef, _LIST_OUTPUTS_CALLBACK);
 
     def listGlobalNames(self, callback):
         """
@@ -748,8 +937,8 @@ class Workspace:
 
         __*Note:* This method is asynchronous__
         """
-        self._listRequests['globalNames'] = callback
-        return workspace_list_global_names(byref(self._id), self._listCallbackGlobalNames)
+        self._globalNamesListRequest = callback
+        return LibWorkspaceWeb.workspace_list_global_names(self._idRef, _LIST_GLOBAL_NAMES_CALLBACK)
 
     def onSuccess(self, callback):
         """
@@ -782,8 +971,17 @@ class Workspace:
         """
         self._onErrorFunc = callback
 
-# Prior to using the module, all our c functions need to be initialised.
-_initCInterface()
+# Callbacks shared by every Workspace instance. Each one finds the Workspace an
+# event belongs to, so we only ever create one ctypes trampoline of each kind
+# rather than a set per Workspace. The connected callback is the exception; see
+# `Workspace.__init__`.
+_SUCCESS_CALLBACK           = SUCCESSFUNC(Workspace._dispatchSuccess)
+_FAILED_CALLBACK            = FAILFUNC(Workspace._dispatchFailed)
+_ERROR_CALLBACK             = ERRORFUNC(Workspace._dispatchError)
+_WATCH_CALLBACK             = WATCHFUNC(Workspace._dispatchWatch)
+_LIST_INPUTS_CALLBACK       = Workspace._createListCallback('_inputsListRequest')
+_LIST_OUTPUTS_CALLBACK      = Workspace._createListCallback('_outputsListRequest')
+_LIST_GLOBAL_NAMES_CALLBACK = Workspace._createListCallback('_globalNamesListRequest')
 
 # Make sure that on quit() or exit() calls, all our subprocesses are shut down.
 atexit.register(Workspace._atexit)
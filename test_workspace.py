@@ -1,21 +1,41 @@
 import csiro_workspace.workspace as workspace
 import unittest
 import os.path
+import time
+import collections
+import subprocess
+from unittest import mock
+
+_WSX_PATH = os.path.join(os.path.dirname(__file__), 'test_workspace.wsx')
 
 class TestWorkspace(unittest.TestCase):
 
+    filePath = _WSX_PATH
+
     def setUp(self):
         def onConnected(workspace):
             return True
-        self.filePath = os.path.join(os.path.dirname(__file__), 'test_workspace.wsx')
         self.ws = workspace.Workspace(self.filePath, onConnected)
 
     def tearDown(self):
         self.ws.terminate()
 
+    def _waitUntil(self, predicate, timeoutSec=30):
+        # Callbacks are dispatched from inside poll() on this thread, so wait
+        # by blocking in poll() rather than on a threading primitive.
+        poll = self.ws.poll
+        deadline = time.monotonic() + timeoutSec
+        while not predicate():
+            if time.monotonic() >= deadline:
+                self.fail('Timed out waiting for a workspace callback')
+            poll(100)
+
     def test_fileName(self):
         self.assertEqual(self.ws.fileName, self.filePath)
 
+    def test_isAvailable(self):
+        self.assertTrue(workspace.Workspace.isAvailable())
+
     def test_setInput(self):
         def watchCallback(workspace, watchList):
             self.watchListOut = watchList
@@ -26,13 +46,37 @@ class TestWorkspace(unittest.TestCase):
         self.ws.setInput('Value1', '2')
         self.ws.setInput('Value2', '4')
         self.ws.runOnce()
-        while not self.watchListOut:
-            self.ws.poll()
-        self.assertEqual(len(self.watchListOut.inputs.keys()), 0)
-        self.assertEqual(len(self.watchListOut.outputs.keys()), 1)
-        self.assertEqual(len(self.watchListOut.globalNames.keys()), 0)
+        self._waitUntil(lambda: self.watchListOut)
+        self.assertFalse(self.watchListOut.inputs)
+        self.assertEqual(len(self.watchListOut.outputs), 1)
+        self.assertFalse(self.watchListOut.globalNames)
         self.assertEqual(self.watchListOut.outputs['Result']['value'], 8)
 
+    def test_setInput_bytes(self):
+        def watchCallback(workspace, watchList):
+            self.watchListOut = watchList
+            return True
+        self.watchListOut = None
+        self.ws.watch(callback=watchCallback, watchList=workspace.WatchList.fromIONames(outputs=['Result']), autoDelete=True)
+        self.ws.setInput('Value1', b'3')
+        self.ws.setInput('Value2', b'7')
+        self.ws.runOnce()
+        self._waitUntil(lambda: self.watchListOut)
+        self.assertEqual(self.watchListOut.outputs['Result']['value'], 21)
+
+    def test_setInputs(self):
+        def watchCallback(workspace, watchList):
+            self.watchListOut = watchList
+            return True
+        self.watchListOut = None
+        self.ws.watch(callback=watchCallback, watchList=workspace.WatchList.fromIONames(outputs=['Result']), autoDelete=True)
+        results = self.ws.setInputs({'Value1': '3', 'Value2': '5'})
+        self.assertEqual(['Value1', 'Value2'], list(results))
+        self.assertTrue(all(results.values()))
+        self.ws.runOnce()
+        self._waitUntil(lambda: self.watchListOut)
+        self.assertEqual(self.watchListOut.outputs['Result']['value'], 15)
+
     def test_setGlobalName(self):
         def watchCallback(workspace, watchList):
             self.watchListOut = watchList
@@ -41,11 +85,10 @@ class TestWorkspace(unittest.TestCase):
         self.ws.watch(callback=watchCallback, watchList=workspace.WatchList.fromIONames(globalNames=['StringOut']), autoDelete=True)
         self.ws.setGlobalName('StringIn', '_plus_string')
         self.ws.runOnce()
-        while not self.watchListOut:
-            self.ws.poll()
-        self.assertEqual(len(self.watchListOut.inputs.keys()), 0)
-        self.assertEqual(len(self.watchListOut.outputs.keys()), 0)
-        self.assertEqual(len(self.watchListOut.globalNames.keys()), 1)
+        self._waitUntil(lambda: self.watchListOut)
+        self.assertFalse(self.watchListOut.inputs)
+        self.assertFalse(self.watchListOut.outputs)
+        self.assertEqual(len(self.watchListOut.globalNames), 1)
         self.assertEqual(self.watchListOut.globalNames['StringOut']['value'], 'Result: 0_plus_string')
 
     def test_cancelWatch(self):
@@ -55,14 +98,29 @@ class TestWorkspace(unittest.TestCase):
         self.watchListOut = None
         self.watchListIn = workspace.WatchList.fromIONames(outputs=['Result'])
         self.ws.watch(callback=watchCallback, watchList=self.watchListIn, autoDelete=False)
-        self.ws.setInput('Value1', '2')
-        self.ws.setInput('Value2', '4')
+        self.ws.setInputs({'Value1': '2', 'Value2': '4'})
         self.ws.runOnce()
-        while not self.watchListOut:
-            self.ws.poll()
+        self._waitUntil(lambda: self.watchListOut)
         self.assertEqual(self.watchListOut.id, self.watchListIn.id)
         self.ws.cancelWatch(self.watchListIn.id)
 
+    def test_watching(self):
+        def watchCallback(workspace, watchList):
+            self.watchListOut = watchList
+            return True
+        self.watchListOut = None
+        with self.ws.watching(watchCallback, workspace.WatchList.fromIONames(outputs=['Result'])) as watchId:
+            self.ws.setInputs({'Value1': '2', 'Value2': '4'})
+            self.ws.runOnce()
+            self._waitUntil(lambda: self.watchListOut)
+            self.assertEqual(self.watchListOut.id, watchId)
+        self.assertNotIn(watchId, self.ws._watches)
+
+        with self.assertRaises(ValueError):
+            with self.ws.watching(watchCallback, workspace.WatchList.fromIONames(outputs=['Result'])) as watchId:
+                raise ValueError()
+        self.assertNotIn(watchId, self.ws._watches)
+
     def test_success(self):
         self.called = False
         def successCallback(workspace):
@@ -70,8 +128,7 @@ class TestWorkspace(unittest.TestCase):
             return True
         self.ws.onSuccess(successCallback)
         self.ws.runOnce()
-        while not self.called:
-            self.ws.poll()
+        self._waitUntil(lambda: self.called)
         self.assertTrue(self.called)
 
     def test_error(self):
@@ -82,8 +139,7 @@ class TestWorkspace(unittest.TestCase):
         self.ws.onError(errorCallback)
         self.ws.setInput('Value1', 'not_an_integer')
         self.ws.runOnce()
-        while not self.called:
-            self.ws.poll()
+        self._waitUntil(lambda: self.called)
         self.assertTrue(self.called)
 
     def test_listInputs(self):
@@ -92,15 +148,12 @@ class TestWorkspace(unittest.TestCase):
             return True;
         self.resultsList = None
         self.ws.listInputs(listCallback)
-        while not self.resultsList:
-            self.ws.poll()
-        self.assertEqual(len(self.resultsList.inputs.keys()), 3)
-        self.assertEqual(len(self.resultsList.outputs.keys()), 0)
-        self.assertEqual(len(self.resultsList.globalNames.keys()), 0)
-        self.assertEqual(0, self.resultsList.inputs['Value1']['value'])
-        self.assertEqual(0, self.resultsList.inputs['Value2']['value'])
-        self.assertEqual('int', self.resultsList.inputs['Value1']['type'])
-        self.assertEqual('int', self.resultsList.inputs['Value2']['type'])
+        self._waitUntil(lambda: self.resultsList)
+        self.assertEqual(len(self.resultsList.inputs), 3)
+        self.assertFalse(self.resultsList.outputs)
+        self.assertFalse(self.resultsList.globalNames)
+        self.assertEqual({'type': 'int', 'value': 0}, self.resultsList.inputs['Value1'])
+        self.assertEqual({'type': 'int', 'value': 0}, self.resultsList.inputs['Value2'])
         self.assertEqual('CSIRO::DataExecution::Dependency', self.resultsList.inputs['Dependencies']['type'])
 
     def test_listGlobalNames(self):
@@ -110,17 +163,11 @@ class TestWorkspace(unittest.TestCase):
         self.resultsList = None
         self.ws.setGlobalName('StringIn', 'oh_hello')
         self.ws.listGlobalNames(listCallback)
-        while not self.resultsList:
-            self.ws.poll()
-        self.assertEqual(len(self.resultsList.inputs.keys()), 0)
-        self.assertEqual(len(self.resultsList.outputs.keys()), 0)
-        self.assertEqual(len(self.resultsList.globalNames.keys()), 2)
-        self.assertEqual(len(self.resultsList.globalNames['StringIn'].keys()), 2)
-        self.assertEqual(len(self.resultsList.globalNames['StringOut'].keys()), 2)
-        self.assertEqual('QString', self.resultsList.globalNames['StringIn']['type'])
-        self.assertEqual('QString', self.resultsList.globalNames['StringOut']['type'])
-        self.assertEqual('oh_hello', self.resultsList.globalNames['StringIn']['value'])
-        self.assertEqual('', self.resultsList.globalNames['StringOut']['value'])
+        self._waitUntil(lambda: self.resultsList)
+        self.assertFalse(self.resultsList.inputs)
+        self.assertFalse(self.resultsList.outputs)
+        self.assertEqual({'StringIn': {'type': 'QString', 'value': 'oh_hello'},
+                          'StringOut': {'type': 'QString', 'value': ''}}, self.resultsList.globalNames)
 
     def test_eventLoop(self):
         self.started = False
@@ -139,13 +186,149 @@ class TestWorkspace(unittest.TestCase):
             self.assertTrue(self.started)
             watchListIn = workspace.WatchList.fromIONames(outputs=['Result'])
             self.ws.watch(callback=watchCallback, watchList=watchListIn, autoDelete=False)
-            self.ws.setInput('Value1', 1)
-            self.ws.setInput('Value2', 1)
+            self.ws.setInputs({'Value1': 1, 'Value2': 1})
             self.ws.runContinuously()
             return True
 
         workspace.Workspace.startEventLoop(eventLoopStarted)
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestWorkspace)
-unittest.TextTestRunner(verbosity=0).run(suite)
+class TestLibLoader(unittest.TestCase):
+
+    def test_loadFailure(self):
+        loader = workspace._LibLoader()
+        with mock.patch.object(workspace, '_loadLibrary', side_effect=OSError('not found')) as loadLibrary:
+            self.assertFalse(loader.load())
+            self.assertFalse(loader.load())
+            with self.assertRaises(RuntimeError):
+                loader.server_poll
+        loadLibrary.assert_called_once()
+
+    def test_moduleFunctionNames(self):
+        with mock.patch.object(workspace, 'LibWorkspaceWeb') as lib:
+            self.assertIs(workspace.workspace_run_once, lib.workspace_run_once)
+        with self.assertRaises(AttributeError):
+            workspace.not_a_function
+
+    def test_loadConfigError(self):
+        loader = workspace._LibLoader()
+        with mock.patch.object(workspace, '_getConfig', side_effect=FileNotFoundError()):
+            with self.assertRaises(FileNotFoundError):
+                loader.load()
+        self.assertIsNone(loader._loadError)
+
+class TestWorkspaceCleanup(unittest.TestCase):
+    # These tests don't start a workspace-web process. They use Workspace
+    # objects that were never connected, with a mock standing in for the
+    # process.
+
+    def setUp(self):
+        registry = mock.patch.dict(workspace.Workspace._registered_workspaces, clear=True)
+        registry.start()
+        self.addCleanup(registry.stop)
+        queue = mock.patch.object(workspace.Workspace, '_terminating_processes', collections.deque())
+        queue.start()
+        self.addCleanup(queue.stop)
+        lib = mock.patch.object(workspace, 'LibWorkspaceWeb')
+        self.lib = lib.start()
+        self.addCleanup(lib.stop)
+        config = mock.patch.object(workspace, '_getConfig', return_value={'terminate_timeout_sec': 10})
+        config.start()
+        self.addCleanup(config.stop)
+
+    def _fakeWorkspace(self, key):
+        ws = workspace.Workspace.__new__(workspace.Workspace)
+        ws._key = key
+        ws._idRef = None
+        ws._terminating = False
+        ws._process = mock.Mock(spec=subprocess.Popen)
+        ws._watches = {}
+        workspace.Workspace._registered_workspaces[key] = ws
+        return ws
+
+    def test_cleanupKeepsNewerRegistration(self):
+        old = self._fakeWorkspace(1)
+        new = self._fakeWorkspace(1)
+        old._cleanup()
+        self.assertIs(workspace.Workspace._registered_workspaces[1], new)
+        new._cleanup()
+        self.assertNotIn(1, workspace.Workspace._registered_workspaces)
+
+    def test_atexitKeepsKillDeadline(self):
+        ws = self._fakeWorkspace(1)
+        ws._terminating = True
+        process = ws._process
+        process.wait.side_effect = subprocess.TimeoutExpired('workspace-web', 0)
+        workspace.Workspace._terminating_processes.append((time.monotonic() - 1, ws))
+        workspace.Workspace._atexit()
+        process.wait.assert_called_once_with(0)
+        process.kill.assert_called_once_with()
+
+    def test_terminateIsIdempotent(self):
+        ws = self._fakeWorkspace(1)
+        ws.terminate()
+        ws.terminate()
+        self.lib.workspace_terminate.assert_called_once_with(None)
+        self.assertEqual(len(workspace.Workspace._terminating_processes), 1)
+        killDeadline, queued = workspace.Workspace._terminating_processes[0]
+        self.assertIs(queued, ws)
+        self.assertGreater(killDeadline, time.monotonic() + 9)
+
+    def test_pollCleansUpExitedProcess(self):
+        ws = self._fakeWorkspace(1)
+        process = ws._process
+        process.poll.return_value = 0
+        workspace.Workspace._terminating_processes.append((time.monotonic() + 10, ws))
+        workspace.Workspace.poll()
+        self.lib.server_poll.assert_called_once_with(0)
+        process.kill.assert_not_called()
+        self.assertIsNone(ws._process)
+        self.assertFalse(workspace.Workspace._terminating_processes)
+        self.assertFalse(workspace.Workspace._registered_workspaces)
+
+    def test_pollKillsOverdueProcess(self):
+        ws = self._fakeWorkspace(1)
+        process = ws._process
+        process.poll.return_value = None
+        workspace.Workspace._terminating_processes.append((time.monotonic() - 1, ws))
+        workspace.Workspace.poll()
+        process.kill.assert_called_once_with()
+        self.assertFalse(workspace.Workspace._terminating_processes)
+        self.assertFalse(workspace.Workspace._registered_workspaces)
+
+    def test_pollStopsAtFirstLiveProcess(self):
+        live = self._fakeWorkspace(1)
+        exited = self._fakeWorkspace(2)
+        live._process.poll.return_value = None
+        exited._process.poll.return_value = 0
+        now = time.monotonic()
+        workspace.Workspace._terminating_processes.extend([(now + 10, live), (now + 11, exited)])
+        workspace.Workspace.poll()
+        live._process.kill.assert_not_called()
+        exited._process.poll.assert_not_called()
+        self.assertEqual([live, exited], [ws for killDeadline, ws in workspace.Workspace._terminating_processes])
+
+    def test_atexitKillsStragglers(self):
+        exited = self._fakeWorkspace(1)
+        straggler = self._fakeWorkspace(2)
+        exitedProcess = exited._process
+        stragglerProcess = straggler._process
+        stragglerProcess.wait.side_effect = subprocess.TimeoutExpired('workspace-web', 10)
+        workspace.Workspace._atexit()
+        self.assertEqual(self.lib.workspace_terminate.call_count, 2)
+        exitedProcess.kill.assert_not_called()
+        stragglerProcess.kill.assert_called_once_with()
+        self.assertFalse(workspace.Workspace._terminating_processes)
+        self.assertFalse(workspace.Workspace._registered_workspaces)
+
+    def test_watchingFailedWatch(self):
+        ws = self._fakeWorkspace(1)
+        self.lib.workspace_watch.return_value = 0
+        with self.assertRaises(RuntimeError):
+            with ws.watching(lambda ws, watchList: True, workspace.WatchList.fromIONames(outputs=['Result'])):
+                self.fail('Block should not run when the watch fails')
+        self.assertFalse(ws._watches)
+        self.lib.workspace_cancel_watch.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main(verbosity=0, buffer=True, exit=False)
 